@@ -1,18 +1,24 @@
-from fastapi import FastAPI, APIRouter, HTTPException, WebSocket, WebSocketDisconnect, Request
+from fastapi import FastAPI, APIRouter, HTTPException, WebSocket, Request
 from fastapi.responses import JSONResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 import os
+import time
+import asyncio
 import logging
 import hashlib
 import hmac
 import json
+import orjson
 import random
+import anyio
 import aiosqlite
+from aiosqlitepool import SQLiteConnectionPool
+from contextlib import asynccontextmanager
 from pathlib import Path
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, field_validator
 from typing import List, Optional, Dict, Set
-from datetime import datetime, timezone
+from datetime import datetime
 import httpx
 from urllib.parse import parse_qsl
 
@@ -20,9 +26,65 @@ ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN', '')
+_SECRET_KEY = hmac.new(b'WebAppData', TELEGRAM_BOT_TOKEN.encode(), hashlib.sha256).digest() if TELEGRAM_BOT_TOKEN else None
 DB_PATH = ROOT_DIR / 'ghostchat.db'
 
-app = FastAPI()
+SQLITE_PRAGMAS = (
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA busy_timeout=5000',
+    'PRAGMA cache_size=-20000',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA foreign_keys=ON',
+)
+
+write_pool: Optional[SQLiteConnectionPool] = None
+read_pool: Optional[SQLiteConnectionPool] = None
+tg_client: Optional[httpx.AsyncClient] = None
+
+async def configure_connection(db: aiosqlite.Connection) -> aiosqlite.Connection:
+    db.row_factory = aiosqlite.Row
+    for pragma in SQLITE_PRAGMAS:
+        await db.execute(pragma)
+    return db
+
+async def connection_factory() -> aiosqlite.Connection:
+    db = await aiosqlite.connect(DB_PATH)
+    await db.execute('PRAGMA journal_mode=WAL')
+    return await configure_connection(db)
+
+async def connection_factory_ro() -> aiosqlite.Connection:
+    return await configure_connection(await aiosqlite.connect(f"file:{DB_PATH}?mode=ro", uri=True))
+
+@asynccontextmanager
+async def ro_conn():
+    async with read_pool.connection() as db:
+        yield db
+
+@asynccontextmanager
+async def rw_conn():
+    async with write_pool.connection() as db:
+        await db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            await db.rollback()
+            raise
+        await db.commit()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global write_pool, read_pool, tg_client
+    anyio.to_thread.current_default_thread_limiter().total_tokens = 200
+    write_pool = SQLiteConnectionPool(connection_factory, pool_size=1)
+    await init_db()
+    read_pool = SQLiteConnectionPool(connection_factory_ro, pool_size=os.cpu_count() or 4)
+    tg_client = httpx.AsyncClient(base_url="https://api.telegram.org", timeout=5.0, http2=True)
+    yield
+    await tg_client.aclose()
+    await read_pool.close()
+    await write_pool.close()
+
+app = FastAPI(lifespan=lifespan)
 api_router = APIRouter(prefix="/api")
 
 logging.basicConfig(level=logging.INFO)
@@ -47,13 +109,9 @@ class ConnectionManager:
             logger.info(f"User {user_id} disconnected. Total: {len(self.active_connections)}")
     
     async def broadcast_status(self, user_id: str, status: str):
-        message = {"type": "status", "user_id": user_id, "status": status}
-        for uid, ws in self.active_connections.items():
-            if uid != user_id:
-                try:
-                    await ws.send_json(message)
-                except:
-                    pass
+        payload = orjson.dumps({"type": "status", "user_id": user_id, "status": status}).decode()
+        peers = [ws for uid, ws in list(self.active_connections.items()) if uid != user_id]
+        await asyncio.gather(*(ws.send_text(payload) for ws in peers), return_exceptions=True)
     
     def is_online(self, user_id: str) -> bool:
         return user_id in self.active_connections
@@ -64,7 +122,7 @@ class ConnectionManager:
     async def send_to_user(self, user_id: str, message: dict):
         if user_id in self.active_connections:
             try:
-                await self.active_connections[user_id].send_json(message)
+                await self.active_connections[user_id].send_text(orjson.dumps(message).decode())
                 return True
             except Exception as e:
                 logger.error(f"Failed to send to {user_id}: {e}")
@@ -80,6 +138,7 @@ class ConnectionManager:
             self.typing_users[recipient_id].discard(sender_id)
 
 manager = ConnectionManager()
+PONG = orjson.dumps({"type": "pong"}).decode()
 
 class UserUpdate(BaseModel):
     name: Optional[str] = None
@@ -99,51 +158,69 @@ class UserResponse(BaseModel):
     notifications_enabled: bool = True
     created_at: str
 
+    @field_validator('notifications_enabled', mode='before')
+    @classmethod
+    def coerce_notifications(cls, v):
+        return bool(v)
+
 class ContactAdd(BaseModel):
     target_anonymous_id: str
 
+MIGRATIONS = (
+    '''
+    CREATE TABLE IF NOT EXISTS users (
+        id TEXT PRIMARY KEY,
+        telegram_id TEXT UNIQUE NOT NULL,
+        anonymous_id TEXT UNIQUE NOT NULL,
+        name TEXT,
+        status TEXT,
+        gender TEXT,
+        avatar_url TEXT,
+        notifications_enabled INTEGER DEFAULT 1,
+        created_at TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS contacts (
+        id TEXT PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        contact_anonymous_id TEXT NOT NULL,
+        added_at TEXT NOT NULL,
+        UNIQUE(user_id, contact_anonymous_id),
+        FOREIGN KEY(user_id) REFERENCES users(id)
+    );
+    ''',
+    '''
+    DROP INDEX IF EXISTS idx_users_telegram;
+    DROP INDEX IF EXISTS idx_users_anonymous;
+    ''',
+    '''
+    CREATE INDEX IF NOT EXISTS idx_contacts_user_added ON contacts(user_id, added_at DESC, contact_anonymous_id);
+    DROP INDEX IF EXISTS idx_contacts_user;
+    ''',
+)
+
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id TEXT PRIMARY KEY,
-                telegram_id TEXT UNIQUE NOT NULL,
-                anonymous_id TEXT UNIQUE NOT NULL,
-                name TEXT,
-                status TEXT,
-                gender TEXT,
-                avatar_url TEXT,
-                notifications_enabled INTEGER DEFAULT 1,
-                created_at TEXT NOT NULL
-            )
-        ''')
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS contacts (
-                id TEXT PRIMARY KEY,
-                user_id TEXT NOT NULL,
-                contact_anonymous_id TEXT NOT NULL,
-                added_at TEXT NOT NULL,
-                UNIQUE(user_id, contact_anonymous_id),
-                FOREIGN KEY(user_id) REFERENCES users(id)
-            )
-        ''')
-        await db.execute('CREATE INDEX IF NOT EXISTS idx_users_telegram ON users(telegram_id)')
-        await db.execute('CREATE INDEX IF NOT EXISTS idx_users_anonymous ON users(anonymous_id)')
-        await db.execute('CREATE INDEX IF NOT EXISTS idx_contacts_user ON contacts(user_id)')
-        await db.commit()
+    async with write_pool.connection() as db:
+        await db.execute('PRAGMA journal_mode=WAL')
+        cursor = await db.execute('PRAGMA user_version')
+        (version,) = await cursor.fetchone()
+        for target, script in enumerate(MIGRATIONS[version:], start=version + 1):
+            await db.executescript(f'BEGIN IMMEDIATE;{script}PRAGMA user_version = {target};\nCOMMIT;')
     logger.info("Database initialized")
 
-@app.on_event("startup")
-async def startup():
-    await init_db()
+USER_COLUMNS = 'id, telegram_id, anonymous_id, name, status, gender, avatar_url, notifications_enabled, created_at'
+ANONYMOUS_ID_ATTEMPTS = 5
+
+_iso_second = (0, '')
 
-async def generate_anonymous_id() -> str:
-    async with aiosqlite.connect(DB_PATH) as db:
-        while True:
-            anonymous_id = str(random.randint(1000000, 9999999))
-            cursor = await db.execute('SELECT id FROM users WHERE anonymous_id = ?', (anonymous_id,))
-            if not await cursor.fetchone():
-                return anonymous_id
+def now_iso() -> str:
+    global _iso_second
+    ms = time.time_ns() // 1_000_000
+    sec, prefix = _iso_second
+    if ms // 1000 != sec:
+        sec = ms // 1000
+        prefix = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(sec))
+        _iso_second = (sec, prefix)
+    return f"{prefix}.{ms % 1000:03d}Z"
 
 def validate_telegram_data(init_data: str) -> Optional[dict]:
     if not TELEGRAM_BOT_TOKEN:
@@ -154,9 +231,8 @@ def validate_telegram_data(init_data: str) -> Optional[dict]:
         if not hash_value:
             return None
         data_check_string = '\n'.join(f'{k}={v}' for k, v in sorted(parsed.items()))
-        secret_key = hmac.new(b'WebAppData', TELEGRAM_BOT_TOKEN.encode(), hashlib.sha256).digest()
-        calculated_hash = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
-        if calculated_hash == hash_value:
+        calculated_hash = hmac.new(_SECRET_KEY, data_check_string.encode(), hashlib.sha256).hexdigest()
+        if hmac.compare_digest(calculated_hash, hash_value):
             user_data = json.loads(parsed.get('user', '{}'))
             return {"user": user_data}
         return None
@@ -187,54 +263,40 @@ async def auth_telegram(request: Request):
     if not telegram_id:
         raise HTTPException(status_code=400, detail="Missing telegram_id")
     
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute('SELECT * FROM users WHERE telegram_id = ?', (telegram_id,))
-        user = await cursor.fetchone()
-        
-        if user:
-            return UserResponse(
-                id=user['id'], telegram_id=user['telegram_id'], anonymous_id=user['anonymous_id'],
-                name=user['name'], status=user['status'], gender=user['gender'],
-                avatar_url=user['avatar_url'], notifications_enabled=bool(user['notifications_enabled']),
-                created_at=user['created_at']
-            )
-        
-        user_id = hashlib.sha256(f"{telegram_id}{datetime.now().isoformat()}".encode()).hexdigest()[:16]
-        anonymous_id = await generate_anonymous_id()
-        created_at = datetime.now(timezone.utc).isoformat()
-        
-        await db.execute('INSERT INTO users (id, telegram_id, anonymous_id, created_at) VALUES (?, ?, ?, ?)',
-                        (user_id, telegram_id, anonymous_id, created_at))
-        await db.commit()
+    user_id = hashlib.sha256(f"{telegram_id}{datetime.now().isoformat()}".encode()).hexdigest()[:16]
+    created_at = now_iso()
+    
+    async with rw_conn() as db:
+        for _ in range(ANONYMOUS_ID_ATTEMPTS):
+            anonymous_id = f"{random.randint(1000000, 9999999)}"
+            try:
+                cursor = await db.execute(f'''
+                    INSERT INTO users (id, telegram_id, anonymous_id, created_at) VALUES (?, ?, ?, ?)
+                    ON CONFLICT(telegram_id) DO UPDATE SET telegram_id = excluded.telegram_id
+                    RETURNING {USER_COLUMNS}
+                ''', (user_id, telegram_id, anonymous_id, created_at))
+                user = await cursor.fetchone()
+                break
+            except aiosqlite.IntegrityError as e:
+                if 'anonymous_id' not in str(e):
+                    raise
+        else:
+            raise HTTPException(status_code=503, detail="Could not allocate anonymous id")
         
-        return UserResponse(id=user_id, telegram_id=telegram_id, anonymous_id=anonymous_id,
-                           notifications_enabled=True, created_at=created_at)
+        return UserResponse.model_validate(dict(user))
 
 @api_router.get("/user/me", response_model=UserResponse)
 async def get_current_user(telegram_id: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    async with ro_conn() as db:
         cursor = await db.execute('SELECT * FROM users WHERE telegram_id = ?', (telegram_id,))
         user = await cursor.fetchone()
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
-        return UserResponse(
-            id=user['id'], telegram_id=user['telegram_id'], anonymous_id=user['anonymous_id'],
-            name=user['name'], status=user['status'], gender=user['gender'],
-            avatar_url=user['avatar_url'], notifications_enabled=bool(user['notifications_enabled']),
-            created_at=user['created_at']
-        )
+        return UserResponse.model_validate(dict(user))
 
 @api_router.put("/user/me", response_model=UserResponse)
 async def update_user(telegram_id: str, update: UserUpdate):
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute('SELECT * FROM users WHERE telegram_id = ?', (telegram_id,))
-        user = await cursor.fetchone()
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
-        
+    async with rw_conn() as db:
         updates, values = [], []
         if update.name is not None: updates.append("name = ?"); values.append(update.name)
         if update.status is not None: updates.append("status = ?"); values.append(update.status)
@@ -244,22 +306,17 @@ async def update_user(telegram_id: str, update: UserUpdate):
         
         if updates:
             values.append(telegram_id)
-            await db.execute(f'UPDATE users SET {", ".join(updates)} WHERE telegram_id = ?', values)
-            await db.commit()
-        
-        cursor = await db.execute('SELECT * FROM users WHERE telegram_id = ?', (telegram_id,))
+            cursor = await db.execute(f'UPDATE users SET {", ".join(updates)} WHERE telegram_id = ? RETURNING {USER_COLUMNS}', values)
+        else:
+            cursor = await db.execute(f'SELECT {USER_COLUMNS} FROM users WHERE telegram_id = ?', (telegram_id,))
         user = await cursor.fetchone()
-        return UserResponse(
-            id=user['id'], telegram_id=user['telegram_id'], anonymous_id=user['anonymous_id'],
-            name=user['name'], status=user['status'], gender=user['gender'],
-            avatar_url=user['avatar_url'], notifications_enabled=bool(user['notifications_enabled']),
-            created_at=user['created_at']
-        )
+        if not user:
+            raise HTTPException(status_code=404, detail="User not found")
+        return UserResponse.model_validate(dict(user))
 
 @api_router.get("/user/search")
 async def search_user(anonymous_id: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    async with ro_conn() as db:
         cursor = await db.execute('SELECT anonymous_id, name, status, gender, avatar_url FROM users WHERE anonymous_id = ?', (anonymous_id,))
         user = await cursor.fetchone()
         if not user:
@@ -269,39 +326,37 @@ async def search_user(anonymous_id: str):
 
 @api_router.post("/contacts/add")
 async def add_contact(telegram_id: str, contact: ContactAdd):
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute('SELECT id, anonymous_id FROM users WHERE telegram_id = ?', (telegram_id,))
-        user = await cursor.fetchone()
-        if not user: raise HTTPException(status_code=404, detail="User not found")
-        
-        cursor = await db.execute('SELECT id FROM users WHERE anonymous_id = ?', (contact.target_anonymous_id,))
-        if not await cursor.fetchone(): raise HTTPException(status_code=404, detail="Target user not found")
-        if user['anonymous_id'] == contact.target_anonymous_id: raise HTTPException(status_code=400, detail="Cannot add yourself")
-        
-        cursor = await db.execute('SELECT id FROM contacts WHERE user_id = ? AND contact_anonymous_id = ?', (user['id'], contact.target_anonymous_id))
-        if await cursor.fetchone(): raise HTTPException(status_code=400, detail="Contact already added")
-        
-        contact_id = hashlib.sha256(f"{user['id']}{contact.target_anonymous_id}{datetime.now().isoformat()}".encode()).hexdigest()[:16]
-        await db.execute('INSERT INTO contacts (id, user_id, contact_anonymous_id, added_at) VALUES (?, ?, ?, ?)',
-                        (contact_id, user['id'], contact.target_anonymous_id, datetime.now(timezone.utc).isoformat()))
-        await db.commit()
+    target = contact.target_anonymous_id
+    contact_id = hashlib.sha256(f"{telegram_id}{target}{datetime.now().isoformat()}".encode()).hexdigest()[:16]
+    async with rw_conn() as db:
+        try:
+            cursor = await db.execute('''
+                INSERT INTO contacts (id, user_id, contact_anonymous_id, added_at)
+                SELECT ?, u.id, ?, ? FROM users u
+                WHERE u.telegram_id = ? AND u.anonymous_id != ? AND EXISTS (SELECT 1 FROM users WHERE anonymous_id = ?)
+            ''', (contact_id, target, now_iso(), telegram_id, target, target))
+        except aiosqlite.IntegrityError:
+            raise HTTPException(status_code=400, detail="Contact already added")
+        if cursor.rowcount == 0:
+            cursor = await db.execute('SELECT anonymous_id FROM users WHERE telegram_id = ?', (telegram_id,))
+            user = await cursor.fetchone()
+            if not user: raise HTTPException(status_code=404, detail="User not found")
+            if user['anonymous_id'] == target: raise HTTPException(status_code=400, detail="Cannot add yourself")
+            raise HTTPException(status_code=404, detail="Target user not found")
         return {"message": "Contact added", "contact_id": contact_id}
 
 @api_router.delete("/contacts/{contact_anonymous_id}")
 async def remove_contact(telegram_id: str, contact_anonymous_id: str):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with rw_conn() as db:
         cursor = await db.execute('SELECT id FROM users WHERE telegram_id = ?', (telegram_id,))
         user = await cursor.fetchone()
         if not user: raise HTTPException(status_code=404, detail="User not found")
-        await db.execute('DELETE FROM contacts WHERE user_id = ? AND contact_anonymous_id = ?', (user[0], contact_anonymous_id))
-        await db.commit()
+        await db.execute('DELETE FROM contacts WHERE user_id = ? AND contact_anonymous_id = ?', (user['id'], contact_anonymous_id))
         return {"message": "Contact removed"}
 
 @api_router.get("/contacts")
 async def get_contacts(telegram_id: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    async with ro_conn() as db:
         cursor = await db.execute('SELECT id FROM users WHERE telegram_id = ?', (telegram_id,))
         user = await cursor.fetchone()
         if not user: raise HTTPException(status_code=404, detail="User not found")
@@ -316,32 +371,41 @@ async def get_contacts(telegram_id: str):
                  "gender": c['gender'], "avatar_url": c['avatar_url'], "added_at": c['added_at'],
                  "is_online": manager.is_online(c['contact_anonymous_id'])} for c in contacts]
 
+async def _handle_message(data: dict, anonymous_id: str, send):
+    recipient_id, text = data.get('recipient_id'), data.get('text', '').strip()
+    if recipient_id and text:
+        manager.set_typing(anonymous_id, recipient_id, False)
+        message = {"type": "message", "sender_id": anonymous_id, "text": text, "timestamp": now_iso()}
+        sent = await manager.send_to_user(recipient_id, message)
+        await send(orjson.dumps({"type": "message_sent", "recipient_id": recipient_id, "delivered": sent, "timestamp": message['timestamp']}).decode())
+
+async def _handle_typing(data: dict, anonymous_id: str, send):
+    recipient_id, is_typing = data.get('recipient_id'), data.get('is_typing', True)
+    if recipient_id:
+        manager.set_typing(anonymous_id, recipient_id, is_typing)
+        await manager.send_to_user(recipient_id, {"type": "typing", "sender_id": anonymous_id, "is_typing": is_typing})
+
+async def _handle_ping(data: dict, anonymous_id: str, send):
+    await send(PONG)
+
+WS_HANDLERS = {'message': _handle_message, 'typing': _handle_typing, 'ping': _handle_ping}
+
 @app.websocket("/ws/{anonymous_id}")
 async def websocket_endpoint(websocket: WebSocket, anonymous_id: str):
     await manager.connect(anonymous_id, websocket)
+    send, handlers, loads = websocket.send_text, WS_HANDLERS, orjson.loads
     try:
-        while True:
-            data = await websocket.receive_json()
-            if data.get('type') == 'message':
-                recipient_id, text = data.get('recipient_id'), data.get('text', '').strip()
-                if recipient_id and text:
-                    manager.set_typing(anonymous_id, recipient_id, False)
-                    message = {"type": "message", "sender_id": anonymous_id, "text": text, "timestamp": datetime.now(timezone.utc).isoformat()}
-                    sent = await manager.send_to_user(recipient_id, message)
-                    await websocket.send_json({"type": "message_sent", "recipient_id": recipient_id, "delivered": sent, "timestamp": message['timestamp']})
-            elif data.get('type') == 'typing':
-                recipient_id, is_typing = data.get('recipient_id'), data.get('is_typing', True)
-                if recipient_id:
-                    manager.set_typing(anonymous_id, recipient_id, is_typing)
-                    await manager.send_to_user(recipient_id, {"type": "typing", "sender_id": anonymous_id, "is_typing": is_typing})
-            elif data.get('type') == 'ping':
-                await websocket.send_json({"type": "pong"})
-    except WebSocketDisconnect:
-        manager.disconnect(anonymous_id)
-        await manager.broadcast_status(anonymous_id, "offline")
+        async for raw in websocket.iter_text():
+            data = loads(raw)
+            handler = handlers.get(data.get('type'))
+            if handler:
+                await handler(data, anonymous_id, send)
     except Exception as e:
         logger.error(f"WebSocket error: {e}")
         manager.disconnect(anonymous_id)
+    else:
+        manager.disconnect(anonymous_id)
+        await manager.broadcast_status(anonymous_id, "offline")
 
 @api_router.post("/telegram/webhook")
 async def telegram_webhook(request: Request):
@@ -353,10 +417,9 @@ async def telegram_webhook(request: Request):
         text = message.get('text', '')
         if text == '/start':
             webapp_url = os.environ.get('WEBAPP_URL', 'https://massagertg.tw1.su')
-            async with httpx.AsyncClient() as client:
-                await client.post(f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage",
-                    json={"chat_id": chat_id, "text": "👻 GhostChat - Анонимный Мессенджер\n\nНажмите кнопку ниже:",
-                          "reply_markup": {"inline_keyboard": [[{"text": "🚀 Открыть GhostChat", "web_app": {"url": webapp_url}}]]}})
+            await tg_client.post(f"/bot{TELEGRAM_BOT_TOKEN}/sendMessage",
+                json={"chat_id": chat_id, "text": "👻 GhostChat - Анонимный Мессенджер\n\nНажмите кнопку ниже:",
+                      "reply_markup": {"inline_keyboard": [[{"text": "🚀 Открыть GhostChat", "web_app": {"url": webapp_url}}]]}})
         return {"ok": True}
     except Exception as e:
         logger.error(f"Webhook error: {e}")